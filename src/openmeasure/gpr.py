@@ -10,7 +10,7 @@ MODULE: gpr.py
     Please report any bug to: alberto.procacci@ulb.be
 '''
 
-import copy
+import warnings
 import numpy as np
 import torch
 import gpytorch
@@ -18,6 +18,8 @@ from scipy.stats import kurtosis
 from gpytorch.likelihoods import MultitaskGaussianLikelihood
 from gpytorch.distributions import MultitaskMultivariateNormal, MultivariateNormal
 from gpytorch.mlls import ExactMarginalLogLikelihood
+from gpytorch.utils.warnings import GPInputWarning
+from linear_operator.utils.errors import NanError, NotPSDError
 from .sparse_sensing import ROM
 import cvxpy as cp
 
@@ -33,21 +35,25 @@ class ExactGPModel(gpytorch.models.ExactGP):
     
     Y_train : numpy array
         matrix of dimensions (p,q) where p is the number of operating conditions
-        and q is the number of retained coefficients.
+        and q is the number of retained coefficients. For a batch of q independent
+        models, its dimensions are (q,p).
 
     likelihood : gpytorch.likelihoods
-        one dimensional likelihood from gpytorch.likelihoods.
+        one dimensional likelihood from gpytorch.likelihoods. For a batch of q 
+        independent models, it has batch_shape=torch.Size([q]).
         
     mean : gpytorch.means
-        mean function gpytorch.means.
+        mean function gpytorch.means. For a batch of q independent models, it has
+        batch_shape=torch.Size([q]).
     
     kernel : gpytorch.kernels
-        kernel function from gpytorch.kernels.
+        kernel function from gpytorch.kernels. For a batch of q independent models, 
+        it has batch_shape=torch.Size([q]).
         
     Methods
     ----------
     forward(x)
-        Return the multivariate distribution given the input x.
+        Return the (batch of) multivariate distribution given the input x.
     
     '''
     
@@ -62,9 +68,9 @@ class ExactGPModel(gpytorch.models.ExactGP):
         kernel_x = self.covar_module(x)
         return MultivariateNormal(mean_x, kernel_x)
 
-class BatchIndipendentMultitaskGPModel(gpytorch.models.ExactGP):
+class BatchIndipendentMultitaskGPModel(ExactGPModel):
     '''
-    Subclass used to build a Multitask GP Model inheriting from the ExactGP model. 
+    Subclass used to build a Multitask GP Model inheriting from the ExactGPModel. 
     A Multitask model is needed when the target variable has multiple components.
     
     Attributes
@@ -92,18 +98,9 @@ class BatchIndipendentMultitaskGPModel(gpytorch.models.ExactGP):
         Return the multivariate distribution given the input x.
     
     '''
-    
-    def __init__(self, X_train, Y_train, likelihood, mean, kernel):
-        super().__init__(X_train, Y_train, likelihood)
-    
-        self.mean_module = mean
-        self.covar_module = kernel
         
     def forward(self, x):
-        mean_x = self.mean_module(x)
-        kernel_x = self.covar_module(x)
-        return MultitaskMultivariateNormal.from_batch_mvn(MultivariateNormal(mean_x, 
-                                                                             kernel_x))
+        return MultitaskMultivariateNormal.from_batch_mvn(super().forward(x))
 
 class PIMultitaskGPModel(gpytorch.models.ExactGP):
     '''
@@ -183,9 +180,20 @@ class GPR(ROM):
         operating conditions.
     
     gpr_type : str, optional.
-        If 'SingleTask', a GPR model is trained for each of the r latent dimensions.
+        If 'SingleTask', a batch of independent GPR models is trained at once, one 
+        for each of the r latent dimensions.
         If 'MultiTask', the a single multitask GPR is trained for all the latent dimensions.
         The default is 'SingleTask'.     
+    
+    device : str or torch.device, optional.
+        Device used to train and evaluate the GPR models. The default is None, 
+        which selects 'cuda' if available and 'cpu' otherwise.
+    
+    dtype : torch.dtype, optional.
+        Precision used to train and evaluate the GPR models. If train, update or predict
+        fails in single precision because of a non positive definite covariance or NaNs,
+        the models are moved to double precision and the call is repeated. The default 
+        is torch.float32.
         
     Methods
     ----------
@@ -206,10 +214,17 @@ class GPR(ROM):
         Updates the model with new data.
     '''
 
-    def __init__(self, X, n_features, xyz, P, gpr_type='SingleTask'):
+    def __init__(self, X, n_features, xyz, P, gpr_type='SingleTask', device=None, 
+                 dtype=torch.float32):
         super().__init__(X, n_features, xyz)
         self.P = P
         self.gpr_type = gpr_type
+        self.dtype = dtype
+        self._optimizer_state = None
+        
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
         
         if P.shape[0] != X.shape[1]:
             raise Exception(f'The number of parameters ({P.shape[0]}) is different' \
@@ -217,39 +232,147 @@ class GPR(ROM):
             exit()
 
 
-    def _train_loop(self, model, likelihood, P0_torch, Vr_torch, i):
+    def _check_batch_shape(self, P0_torch):
+        # The SingleTask modes are trained as a batch, so each module needs one set 
+        # of hyperparameters per mode
+        batch_shape = torch.Size([self.r])
+        with torch.no_grad():
+            shapes = {'mean': self.mean(P0_torch).shape[:-1],
+                      'kernel': self.kernel.batch_shape,
+                      'likelihood': self.likelihood.noise.shape[:-1]}
+        
+        for name, shape in shapes.items():
+            if shape != batch_shape:
+                raise ValueError(f'The {name} of a SingleTask model must have batch_shape=' \
+                                 f'torch.Size([{self.r}]), one for each mode, but it has ' \
+                                 f'batch_shape={shape}.')
+
+    def _to_torch(self, x):
+        # No copy is made when x is already contiguous and of the target dtype on the CPU
+        return torch.as_tensor(np.ascontiguousarray(x), dtype=self.dtype, device=self.device)
+
+    def _to_float64(self):
+        # Move the trained models and their training data to double precision. Going 
+        # back to train mode drops the prediction strategy computed in single precision
+        self.dtype = torch.float64
+        self.models[0].train()
+        self.models[0].to(self.dtype)
+        self.likelihoods[0].to(self.dtype)
+        self.P0_torch = self.P0_torch.to(self.dtype)
+        self.Vr_torch = self.Vr_torch.to(self.dtype)
+
+    def _solver_ctx(self, n):
+        # Above the Cholesky size limit GPyTorch switches to CG solves, where the
+        # pivoted Cholesky preconditioner only pays off for large training sets
+        if n < 2000:
+            return gpytorch.settings.max_preconditioner_size(0)
+        else:
+            return gpytorch.settings.max_preconditioner_size(15)
+
+    def _train_step(self, model, mll, optimizer, P0_torch, Vr_torch):
+        # Forward and backward pass of a single training iteration
+        optimizer.zero_grad()
+        output = model(P0_torch)
+        # The batched SingleTask model returns one loss per mode
+        loss = -mll(output, Vr_torch).sum()
+        loss.backward()
+        
+        return loss
+
+    def _train_loop(self, model, likelihood, P0_torch, Vr_torch, warm_start=False):
         model.train()
         likelihood.train()
+        
+        # A warm start only fine-tunes hyperparameters that are already trained
+        max_iter = self.max_iter
+        if warm_start:
+            max_iter = min(self.max_iter, max(20, self.max_iter//10))
     
-        optimizer = torch.optim.Adam(model.parameters(), lr=self.lr)
+        if self.optimizer == 'adam':
+            optimizer = torch.optim.Adam(model.parameters(), lr=self.lr)
+        elif self.optimizer == 'lbfgs':
+            optimizer = torch.optim.LBFGS(model.parameters(), lr=self.lr, max_iter=20, 
+                                          line_search_fn='strong_wolfe')
+        else:
+            raise ValueError('The optimizer value is wrong.')
+
+        if warm_start and self._optimizer_state is not None:
+            try:
+                optimizer.load_state_dict(self._optimizer_state)
+            except ValueError:
+                # The parameters of the model changed since the last training
+                pass
 
         mll = ExactMarginalLogLikelihood(likelihood, model)
-        loss_old = 1e10
-        e = 1e10
-        j = 0
-        while (e > self.rel_error) and (j < self.max_iter):
-            optimizer.zero_grad()
-            output = model(P0_torch)
-            loss = -mll(output, Vr_torch)
-            loss.backward()
-            e = torch.abs(loss - loss_old).item()
-            loss_old = loss
-            if self.verbose == True:
-                if self.gpr_type == 'SingleTask':
-                    noise_avg = np.mean(model.likelihood.noise.detach().numpy())
-                    print(f'Iter {j+1:d}/{self.max_iter:d} - Mode: {i+1:d}/{self.r:d} - Loss: {loss.item():.2e} - ' \
-                    f'Mean noise: {noise_avg:.2e}')
+
+        # torch.compile is only available from PyTorch 2.0
+        train_step = self._train_step
+        if self.use_compile and hasattr(torch, 'compile'):
+            train_step = torch.compile(self._train_step)
+
+        def closure():
+            return train_step(model, mll, optimizer, P0_torch, Vr_torch)
+        
+        # Larger jitter for the Cholesky factorization in single precision (the
+        # double precision jitter is not affected)
+        with gpytorch.settings.cholesky_jitter(1e-4), self._solver_ctx(P0_torch.shape[0]):
+            if warm_start:
+                with torch.no_grad():
+                    loss_old = -mll(model(P0_torch), Vr_torch).sum()
+            else:
+                loss_old = 1e10
+            e = 1e10
+            j = 0
+            while (e > self.rel_error) and (j < max_iter):
+                if self.optimizer == 'lbfgs':
+                    loss = optimizer.step(closure)
                 else:
-                    print(f'Iter {j+1:d}/{self.max_iter:d} - Loss: {loss.item():.2e} - ' \
-                         f'Noise: {model.likelihood.noise.item():.2e}')
-                    
-            optimizer.step()
-            j += 1
+                    loss = train_step(model, mll, optimizer, P0_torch, Vr_torch)
+            
+                # The stopping criterion is moved to the host only every 10 iterations,
+                # except for L-BFGS where each iteration already runs several steps
+                delta = torch.abs(loss.detach() - loss_old)
+                loss_old = loss.detach()
+                if self.optimizer == 'lbfgs' or j % 10 == 9:
+                    e = delta.item()
+
+                if self.verbose == True:
+                    if self.gpr_type == 'SingleTask':
+                        noise_avg = np.mean(model.likelihood.noise.detach().cpu().numpy())
+                        print(f'Iter {j+1:d}/{max_iter:d} - Loss: {loss.item():.2e} - ' \
+                        f'Mean noise: {noise_avg:.2e}')
+                    else:
+                        print(f'Iter {j+1:d}/{max_iter:d} - Loss: {loss.item():.2e} - ' \
+                             f'Noise: {model.likelihood.noise.item():.2e}')
+            
+                if self.optimizer == 'adam':
+                    optimizer.step()
+                j += 1
+
+        self._optimizer_state = optimizer.state_dict()
 
-        Vr_sigma = output.stddev.detach().numpy()
+        Vr_sigma = None
+        if self.compute_sigma or self.verbose:
+            Vr_sigma = self._train_sigma(model, likelihood, P0_torch)
         
         return model, likelihood, Vr_sigma
 
+    def _train_sigma(self, model, likelihood, P0_torch):
+        # The model is left in eval mode, so that predict reuses the prediction strategy
+        model.eval()
+        likelihood.eval()
+        
+        # Evaluating the model on its own training inputs is intended here
+        with torch.no_grad(), gpytorch.settings.fast_pred_var(), warnings.catch_warnings():
+            warnings.filterwarnings('ignore', message='The input matches the stored training data',
+                                    category=GPInputWarning)
+            Vr_sigma = likelihood(model(P0_torch)).stddev.cpu().numpy()
+        
+        if self.gpr_type == 'SingleTask':
+            Vr_sigma = Vr_sigma.T
+        
+        return Vr_sigma
+
     def scale_GPR_data(self, P, scale_type):
         '''
         Return the scaled input and target for the GPR model.
@@ -269,65 +392,32 @@ class GPR(ROM):
 
         '''
         
-        P_cnt = np.zeros_like(P)
-        P_scl = np.zeros_like(P)
-        
-        for i in range(P.shape[1]):
-            x = P[:,i]
-            P_cnt[:,i] = np.mean(x)
-            
-            if scale_type == 'std':
-                P_scl[:,i] = np.std(x)
-            
-            elif scale_type == 'none':
-                P_scl[:,i] = 1.
-            
-            elif scale_type == 'pareto':
-                P_scl[:,i] = np.sqrt(np.std(x))
-            
-            elif scale_type == 'vast':
-                scl_factor = np.std(x)**2/np.average(x)
-                P_scl[:,i] = scl_factor
-            
-            elif scale_type == 'range':
-                scl_factor = np.max(x) - np.min(x)
-                P_scl[:,i] = scl_factor
-                
-            elif scale_type == 'level':
-                P_scl[:,i] = np.average(x)
-                
-            elif scale_type == 'max':
-                P_scl[:,i] = np.max(x)
-            
-            elif scale_type == 'variance':
-                P_scl[:,i] = np.var(x)
-            
-            elif scale_type == 'median':
-                P_scl[:,i] = np.median(x)
-            
-            elif scale_type == 'poisson':
-                scl_factor = np.sqrt(np.average(x))
-                P_scl[:,i] = scl_factor
-            
-            elif scale_type == 'vast_2':
-                scl_factor = (np.std(x)**2 * kurtosis(x, None)**2)/np.average(x)
-                P_scl[:,i] = scl_factor
-            
-            elif scale_type == 'vast_3':
-                scl_factor = (np.std(x)**2 * kurtosis(x, None)**2)/np.max(x)
-                P_scl[:,i] = scl_factor
-            
-            elif scale_type == 'vast_4':
-                scl_factor = (np.std(x)**2 * kurtosis(x, None)**2)/(np.max(x)-np.min(x))
-                P_scl[:,i] = scl_factor
-            
-            elif scale_type == 'l2-norm':
-                scl_factor = np.linalg.norm(x.flatten())
-                P_scl[:,i] = scl_factor
-            
-            else:
-                raise NotImplementedError('The scaling method selected has not been '\
-                                          'implemented yet')
+        P_cnt = np.mean(P, axis=0)
+        
+        # Each scaling method is evaluated on all the columns at once
+        scl_methods = {
+            'std': lambda: np.std(P, axis=0),
+            'none': lambda: np.ones_like(P_cnt),
+            'pareto': lambda: np.sqrt(np.std(P, axis=0)),
+            'vast': lambda: np.std(P, axis=0)**2/P_cnt,
+            'range': lambda: np.max(P, axis=0) - np.min(P, axis=0),
+            'level': lambda: P_cnt,
+            'max': lambda: np.max(P, axis=0),
+            'variance': lambda: np.var(P, axis=0),
+            'median': lambda: np.median(P, axis=0),
+            'poisson': lambda: np.sqrt(P_cnt),
+            'vast_2': lambda: (np.std(P, axis=0)**2 * kurtosis(P, axis=0)**2)/P_cnt,
+            'vast_3': lambda: (np.std(P, axis=0)**2 * kurtosis(P, axis=0)**2)/np.max(P, axis=0),
+            'vast_4': lambda: ((np.std(P, axis=0)**2 * kurtosis(P, axis=0)**2)
+                               /(np.max(P, axis=0) - np.min(P, axis=0))),
+            'l2-norm': lambda: np.linalg.norm(P, axis=0),
+        }
+        
+        if scale_type not in scl_methods:
+            raise NotImplementedError('The scaling method selected has not been '\
+                                      'implemented yet')
+        
+        P_scl = scl_methods[scale_type]()
                     
         self.P_cnt = P_cnt
         self.P_scl = P_scl
@@ -379,21 +469,22 @@ class GPR(ROM):
         self.X0 = self.scale_data(scaleX_type, axis_cnt)
         if basis is None:
             Ur, Ar, _ = self.decomposition(self.X0, select_modes, n_modes)
+            # The norms of the columns of Ar are the singular values of X0
+            Sigma_r = self.Sigma[:Ar.shape[1]]
         else:
             Ur = basis[0]
             Ar = basis[1]
+            Sigma_r = np.linalg.norm(Ar, axis=0)
 
         self.Ur = Ur
         self.Ar = Ar
         self.r = Ar.shape[1]
         self.d = self.P.shape[1]
         
-        # Get the singular values and the orthonormal basis
-        Vr = np.zeros_like(Ar)
-        Sigma_r = np.zeros((self.r,))
-        for i in range(self.r):
-            Sigma_r[i] = np.linalg.norm(Ar[:,i])
-            Vr[:,i] = Ar[:,i]/Sigma_r[i]
+        # Get the orthonormal basis
+        # Null modes are left unscaled to avoid dividing by zero
+        Sigma_r = np.where(Sigma_r > 0, Sigma_r, 1.)
+        Vr = Ar / Sigma_r[np.newaxis, :]
         
         self.Sigma_r = Sigma_r
         P0 = GPR.scale_GPR_data(self, self.P, scaleP_type)
@@ -402,7 +493,8 @@ class GPR(ROM):
         self.Vr = Vr
     
     def train(self, mean=None, kernel=None, likelihood=None, max_iter=1000, 
-              rel_error=1e-5, lr=0.1, verbose=False):
+              rel_error=1e-5, lr=0.1, optimizer='adam', compute_sigma=False, use_compile=False, 
+              verbose=False):
         '''
         Train the GPR model.
         Return the model and likelihood.
@@ -411,15 +503,17 @@ class GPR(ROM):
         ----------
         mean : gpytorch.means, optional.
             The mean passed to the GPR model. The default is means.ConstantMean.
+            If gpr_type='SingleTask', it must have batch_shape=torch.Size([r]).
 
         kernel : gpytorch.kernels, optional.
             The kernel used for the computation of the covariance matrix. The default
-            is the Matern kernel.
+            is the Matern kernel. If gpr_type='SingleTask', it must have 
+            batch_shape=torch.Size([r]).
 
         likelihood : gpytorch.likelihoods, optional
             The likelihood passed to the GPR model. If gpr_type='SingleTask', the default 
-            is GaussianLikelihood(). If gpr_type='MultiTask', the MultitaskGaussianLikelihood()
-            is the only option.
+            is GaussianLikelihood(batch_shape=torch.Size([r])). If gpr_type='MultiTask', 
+            the MultitaskGaussianLikelihood() is the only option.
         
         max_iter : int, optional
             Maximum number of iterations to train the hyperparameters. The default
@@ -427,12 +521,30 @@ class GPR(ROM):
             
         rel_error : float, optional
             Minimum relative error below which the training of hyperparameters is
-            stopped. The default is 1e-5.
-        
+            stopped. The default is 1e-5. If gpr_type='SingleTask', the r modes are
+            trained as one batch on the sum of their losses, so the criterion is
+            evaluated on the summed loss and all the modes stop together.
+
         lr : float, optional
-            Learning rate of the Adam optimizer used for minimizing the negative log 
+            Learning rate of the optimizer used for minimizing the negative log 
             likelihood. The default is 0.1.
 
+        optimizer : str, optional
+            Optimizer used for minimizing the negative log likelihood. The available
+            options are 'adam' and 'lbfgs'. With 'lbfgs', each iteration runs up to 
+            20 L-BFGS steps with a strong Wolfe line search. The default is 'adam'.
+
+        compute_sigma : bool, optional
+            If True, the uncertainty of the coefficients on the training points, Vr_sigma,
+            is computed after the training. Otherwise, it is computed only when needed
+            by update. Vr_sigma is the posterior predictive standard deviation of the
+            trained model, including the likelihood noise. The default is False.
+
+        use_compile : bool, optional
+            If True, the training iteration is compiled with torch.compile (PyTorch >= 2.0).
+            This pays off for long trainings, as the compilation has an initial cost.
+            The default is False.
+
         verbose : bool, optional
             If True, it will print informations on the training of the hyperparameters.
             The default is False.
@@ -451,10 +563,13 @@ class GPR(ROM):
         self.max_iter = max_iter
         self.rel_error = rel_error 
         self.lr = lr
+        self.optimizer = optimizer
+        self.compute_sigma = compute_sigma
+        self.use_compile = use_compile
         self.verbose = verbose
 
-        P0_torch = torch.from_numpy(self.P0).contiguous().double()
-        Vr_torch = torch.from_numpy(self.Vr).contiguous().double()
+        P0_torch = self._to_torch(self.P0)
+        Vr_torch = self._to_torch(self.Vr)
             
         models = []
         likelihoods = []
@@ -477,40 +592,57 @@ class GPR(ROM):
             likelihoods.append(self.likelihood)
             models.append(BatchIndipendentMultitaskGPModel(P0_torch, Vr_torch, likelihoods[0], 
                                                            self.mean, self.kernel))
-            models[0].double()
-            likelihoods[0].double()
-            
-            models[0], likelihoods[0], Vr_sigma = self._train_loop(models[0], likelihoods[0], P0_torch, Vr_torch, 0)
+            Y_torch = Vr_torch
         
         else:
+            batch_shape = torch.Size([self.r])
+
             if mean is None:
-                self.mean = gpytorch.means.ConstantMean()
+                self.mean = gpytorch.means.ConstantMean(batch_shape=batch_shape)
             
             if kernel is None:
-                self.kernel = gpytorch.kernels.MaternKernel(2.5)
+                self.kernel = gpytorch.kernels.MaternKernel(2.5, batch_shape=batch_shape)
             
             if likelihood is None:
-                self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
-
-            Vr_sigma = np.zeros_like(self.Vr)
-
-            for i in range(self.r):
-                likelihood = copy.deepcopy(self.likelihood)
-                mean = copy.deepcopy(self.mean)
-                kernel = copy.deepcopy(self.kernel)
-                model = ExactGPModel(P0_torch, Vr_torch[:,i], likelihood, mean, kernel)
-                
-                model.double()
-                likelihood.double()
+                self.likelihood = gpytorch.likelihoods.GaussianLikelihood(batch_shape=batch_shape)
 
-                model, likelihood, Vr_sigma[:, i] = self._train_loop(model, likelihood, P0_torch, Vr_torch[:,i], i)
-
-                models.append(model)
-                likelihoods.append(likelihood)
+            # A single batch of r independent models, trained with one batched Cholesky
+            Y_torch = Vr_torch.T.contiguous()
+            likelihoods.append(self.likelihood)
+            models.append(ExactGPModel(P0_torch, Y_torch, likelihoods[0], self.mean, 
+                                       self.kernel))
+        
+        # The modules passed by the user are trained in place, so their initial state 
+        # is kept for a retraining in double precision
+        user_modules = [module for module in (mean, kernel, likelihood) if module is not None]
+        initial_states = [{key: value.detach().clone() for key, value in module.state_dict().items()} 
+                          for module in user_modules]
+
+        models[0].to(self.device, self.dtype)
+        likelihoods[0].to(self.device, self.dtype)
+
+        if self.gpr_type == 'SingleTask':
+            self._check_batch_shape(P0_torch)
+
+        try:
+            models[0], likelihoods[0], Vr_sigma = self._train_loop(models[0], likelihoods[0], P0_torch, Y_torch)
+        except (NotPSDError, NanError):
+            if self.dtype == torch.float64:
+                raise
+            
+            # The covariance is too ill-conditioned for single precision
+            for module, state in zip(user_modules, initial_states):
+                module.load_state_dict(state)
+            
+            self.dtype = torch.float64
+            return self.train(mean, kernel, likelihood, max_iter, rel_error, lr, optimizer, 
+                              compute_sigma, use_compile, verbose)
 
         self.Vr_sigma = Vr_sigma
         self.models = models
         self.likelihoods = likelihoods
+        self.P0_torch = P0_torch
+        self.Vr_torch = Vr_torch
         
         return models, likelihoods
     
@@ -550,53 +682,55 @@ class GPR(ROM):
 
         n_p = P_star.shape[0]
 
-        P0_star = np.zeros_like(P_star)
-        for i in range(P_star.shape[1]):
-            P0_star[:,i] = (P_star[:,i] - self.P_cnt[0,i]) / self.P_scl[0,i]
-        
-        P0_star_torch = torch.from_numpy(P0_star).contiguous().double()
-        
-        if self.gpr_type == 'MultiTask':    
-
-            # Set into eval mode
-            self.models[0].eval()
-            self.likelihoods[0].eval()
-
-            observed_pred = self.likelihoods[0](self.models[0](P0_star_torch))
-            V_pred = observed_pred.mean.detach().numpy()
-            V_sigma = observed_pred.stddev.detach().numpy()
+        P0_star = (P_star - self.P_cnt[np.newaxis, :]) / self.P_scl[np.newaxis, :]
+        
+        P0_star_torch = self._to_torch(P0_star)
+        
+        # Set into eval mode. The prediction strategy, which holds the factorization
+        # of the training covariance, is kept by the model until it is trained again
+        # or its training data are changed, so subsequent calls reuse it.
+        self.models[0].eval()
+        self.likelihoods[0].eval()
+        
+        try:
+            n_train = self.models[0].train_inputs[0].shape[-2]
+            with torch.no_grad(), gpytorch.settings.cholesky_jitter(1e-4), \
+                 self._solver_ctx(n_train):
+                # The variances of all the points are approximated with LOVE
+                with gpytorch.settings.fast_pred_var():
+                    observed_pred = self.likelihoods[0](self.models[0](P0_star_torch))
+                    V_pred = observed_pred.mean.cpu().numpy()
+                    V_sigma = observed_pred.stddev.cpu().numpy()
+            
+                if self.gpr_type == 'MultiTask':    
+                    # The constrained problem needs the exact posterior covariance
+                    if problem_dict is not None:        
+                        for i in range(n_p):
+                            observed_pred = self.likelihoods[0](self.models[0](P0_star_torch[[i], :]))
+                        
+                            problem_dict['mean'].value = observed_pred.mean.T.cpu().numpy()
+                            problem_dict['cov'].value = observed_pred.covariance_matrix.cpu().numpy()
 
-            if problem_dict is not None:        
-                for i in range(n_p):
-                    observed_pred = self.likelihoods[0](self.models[0](P0_star_torch[[i], :]))
-                    
-                    problem_dict['mean'].value = observed_pred.mean.T.detach().numpy()
-                    problem_dict['cov'].value = observed_pred.covariance_matrix.detach().numpy()
+                            if 'bc0_limits' in problem_dict:
+                                problem_dict['bc0_limits'].value = problem_dict['BC0'][:,[i]]
 
-                    if 'bc0_limits' in problem_dict:
-                        problem_dict['bc0_limits'].value = problem_dict['BC0'][:,[i]]
+                            problem_dict['problem'].solve(**kwargs)
+                            V_pred[i, :] =  problem_dict['v'].value.flatten()
 
-                    problem_dict['problem'].solve(**kwargs)
-                    V_pred[i, :] =  problem_dict['v'].value.flatten()
+                else:
+                    # The batched model returns the r predictions with a single call
+                    V_pred = V_pred.T
+                    V_sigma = V_sigma.T
+        except (NotPSDError, NanError):
+            if self.dtype == torch.float64:
+                raise
+            
+            # The covariance is too ill-conditioned for single precision
+            self._to_float64()
+            return self.predict(P_star, problem_dict, **kwargs)
 
-        else:
-            V_pred = np.zeros((n_p, self.r))
-            V_sigma = np.zeros((n_p, self.r))
-
-            for i in range(self.r):
-                # Set into eval mode
-                self.models[i].eval()
-                self.likelihoods[i].eval()
-
-                observed_pred = self.likelihoods[i](self.models[i](P0_star_torch))
-                V_pred[:,i] = observed_pred.mean.detach().numpy()
-                V_sigma[:,i] = observed_pred.stddev.detach().numpy()
-                                
-        A_pred = np.zeros_like(V_pred)
-        A_sigma = np.zeros_like(V_sigma)
-        for i in range(self.r):
-            A_pred[:,i] = self.Sigma_r[i] * V_pred[:,i]
-            A_sigma[:,i] = self.Sigma_r[i] * V_sigma[:,i]
+        A_pred = V_pred * self.Sigma_r[np.newaxis, :]
+        A_sigma = V_sigma * self.Sigma_r[np.newaxis, :]
         
         return A_pred, A_sigma
     
@@ -613,10 +747,16 @@ class GPR(ROM):
             The set of new data in the low dimensional space, size (n_p_new, r).
 
         A_sigma_new : numpy array, optional
-            The uncertainty of the new data. The default is None.
+            The uncertainty of the new data. The default is None. If passed, it is
+            appended to the posterior predictive standard deviation of the model on
+            its current training points, Vr_sigma, and their squares are used as 
+            fixed noise when a SingleTask model is retrained. Once a model uses the
+            fixed noise, the uncertainty is required by all the following updates,
+            and the fixed noise is extended also when the model is not retrained.
         
         retrain : bool, optional
-            If True, the hyperparameters are retrained. The default is False.
+            If True, the hyperparameters are retrained starting from their current
+            values, for at most max(20, max_iter//10) iterations. The default is False.
 
         verbose : bool, optional
             If True, it will print informations on the training of the hyperparameters.
@@ -624,61 +764,79 @@ class GPR(ROM):
 
         '''
         
+        fixed_noise = isinstance(self.models[0].likelihood, 
+                                 gpytorch.likelihoods.FixedNoiseGaussianLikelihood)
+        if fixed_noise and A_sigma_new is None:
+            raise ValueError('A_sigma_new is required to update a model trained with ' \
+                             'fixed noise.')
+        
         self.verbose = verbose
+        Vr_sigma_old = self.Vr_sigma
         
-        # Create new set of parameters
-        P0_new = np.zeros_like(P_new)
-        for i in range(P_new.shape[1]):
-            P0_new[:,i] = (P_new[:,i] - self.P_cnt[0,i]) / self.P_scl[0,i]
-            
-        P0_tot = np.concatenate([self.P0, P0_new], axis=0)
-        P0_tot_torch = torch.from_numpy(P0_tot).contiguous().double()
+        # Create new set of parameters, extending the training data of previous updates
+        P0_new = (P_new - self.P_cnt) / self.P_scl
+        P0_tot_torch = torch.cat([self.P0_torch, self._to_torch(P0_new)], dim=0)
         
         # Create new set of observations
-        Vr_new = np.zeros_like(A_new)
-        for i in range(self.r):
-            # V_sigma_train[:,i] = A_sigma_train[:,i]/self.Sigma_r[i]
-            Vr_new[:,i] = A_new[:,i]/self.Sigma_r[i]
-        
-        Vr_tot = np.concatenate([self.Vr, Vr_new], axis=0)
-        Vr_tot_torch = torch.from_numpy(Vr_tot).contiguous().double()
+        Vr_new = A_new / self.Sigma_r
+        Vr_tot_torch = torch.cat([self.Vr_torch, self._to_torch(Vr_new)], dim=0)
         
         # If the uncertainty is passed, create new set of uncertainties
         if A_sigma_new is not None:
-            Vr_sigma_new = np.zeros_like(A_sigma_new)
-            for i in range(self.r):
-                Vr_sigma_new[:,i] = A_sigma_new[:,i]/self.Sigma_r[i]
+            if self.Vr_sigma is None:
+                self.Vr_sigma = self._train_sigma(self.models[0], self.likelihoods[0], self.P0_torch)
+            
+            Vr_sigma_new = A_sigma_new / self.Sigma_r
 
             Vr_sigma_tot = np.concatenate([self.Vr_sigma, Vr_sigma_new], axis=0)
-            Vr_sigma_tot_torch = torch.from_numpy(Vr_sigma_tot).contiguous().double()
-            self.Vr_sigma = np.zeros_like(Vr_sigma_tot)
+            Vr_sigma_tot_torch = self._to_torch(Vr_sigma_tot)
+            self.Vr_sigma = Vr_sigma_tot
+        else:
+            # The uncertainty of the new points is unknown, it is recomputed when needed
+            self.Vr_sigma = None
                 
         
         if self.gpr_type == 'MultiTask':
-
-                self.models[0].set_train_data(P0_tot_torch, Vr_tot_torch, strict=False)
-                
-                if retrain:
-                    temp = self._train_loop(self.models[0], self.likelihoods[0], P0_tot_torch, Vr_tot_torch, 0)
-                    self.models[0], self.likelihoods[0], self.Vr_sigma = temp
-
+            Y_tot_torch = Vr_tot_torch
         else:
-            for i in range(self.r):
-
-                self.models[i].set_train_data(P0_tot_torch, Vr_tot_torch[:,i], strict=False)
+            Y_tot_torch = Vr_tot_torch.T.contiguous()
+        
+        self.models[0].set_train_data(P0_tot_torch, Y_tot_torch, strict=False)
+        
+        # The fixed noise must have the size of the training data, otherwise GPyTorch
+        # ignores it
+        if self.gpr_type == 'SingleTask' and A_sigma_new is not None:
+            if fixed_noise:
+                self.models[0].likelihood.noise = Vr_sigma_tot_torch.T**2
+            elif retrain:
+                likelihood = gpytorch.likelihoods.FixedNoiseGaussianLikelihood(Vr_sigma_tot_torch.T**2)
+                self.models[0].likelihood = likelihood
+        
+        if retrain:
+            try:
+                temp = self._train_loop(self.models[0], self.likelihoods[0], P0_tot_torch, 
+                                        Y_tot_torch, warm_start=True)
+            except (NotPSDError, NanError):
+                if self.dtype == torch.float64:
+                    raise
                 
-                if retrain:
-                    likelihood = gpytorch.likelihoods.FixedNoiseGaussianLikelihood(Vr_sigma_tot_torch[:, i]**2)
-                    self.models[i].likelihood = likelihood
-                    
-                    temp = self._train_loop(self.models[i], self.likelihoods[i], P0_tot_torch, Vr_tot_torch[:,i], i)
-                    self.models[i], self.likelihoods[i], self.Vr_sigma[:,i] = temp
+                # The covariance is too ill-conditioned for single precision, restore
+                # the previous state in double precision and update again
+                self.Vr_sigma = Vr_sigma_old
+                self._to_float64()
+                return self.update(P_new, A_new, A_sigma_new, retrain, verbose)
+            
+            self.models[0], self.likelihoods[0], self.Vr_sigma = temp
+
+        self.P0_torch = P0_tot_torch
+        self.Vr_torch = Vr_tot_torch
 
 class PIGPR(GPR):
     
-    def __init__(self, X, n_features, xyz, P, P_cstr, AddedLoss):
+    def __init__(self, X, n_features, xyz, P, P_cstr, AddedLoss, device=None, 
+                 dtype=torch.float64):
         
-        super().__init__(X, n_features, xyz, P, 'MultiTask')
+        super().__init__(X, n_features, xyz, P, 'MultiTask', device, dtype)
         self.P_cstr = P_cstr
         self.AddedLoss = AddedLoss
     
@@ -736,16 +894,14 @@ class PIGPR(GPR):
         self.lr = lr
         self.verbose = verbose
 
-        P0_torch = torch.from_numpy(self.P0).contiguous().double()
-        Vr_torch = torch.from_numpy(self.Vr).contiguous().double()
+        P0_torch = self._to_torch(self.P0)
+        Vr_torch = self._to_torch(self.Vr)
         
-        P0_cstr = np.zeros_like(self.P_cstr)
-        for i in range(P0_cstr.shape[1]):
-            P0_cstr[:,i] = (self.P_cstr[:,i] - self.P_cnt[0,i]) / self.P_scl[0,i]
+        P0_cstr = (self.P_cstr - self.P_cnt) / self.P_scl
 
         P0_tot = np.concatenate([self.P0, P0_cstr], axis=0)
         self.P0_tot = P0_tot
-        P0_tot_torch = torch.from_numpy(P0_tot).contiguous().double()
+        P0_tot_torch = self._to_torch(P0_tot)
 
         models = []
         likelihoods = []
@@ -767,8 +923,8 @@ class PIGPR(GPR):
         models.append(PIMultitaskGPModel(P0_torch, Vr_torch, likelihoods[0], 
                                                   self.mean, self.kernel, self.AddedLoss))
         
-        models[0].double()
-        likelihoods[0].double()
+        models[0].to(self.device, self.dtype)
+        likelihoods[0].to(self.device, self.dtype)
         
         models[0], likelihoods[0], Vr_sigma = self._train_loop(models[0], likelihoods[0], P0_torch, 
                                                                Vr_torch, P0_tot_torch, loss_dict)
@@ -776,6 +932,8 @@ class PIGPR(GPR):
         self.Vr_sigma = Vr_sigma
         self.models = models
         self.likelihoods = likelihoods
+        self.P0_torch = P0_torch
+        self.Vr_torch = Vr_torch
         
         return models, likelihoods
 
@@ -807,15 +965,13 @@ class PIGPR(GPR):
             The prediction on the training data.
         
         '''
-        P0_torch = torch.from_numpy(self.P0).contiguous().double()
-        Vr_torch = torch.from_numpy(self.Vr).contiguous().double()
+        P0_torch = self._to_torch(self.P0)
+        Vr_torch = self._to_torch(self.Vr)
         
-        P0_cstr = np.zeros_like(self.P_cstr)
-        for i in range(P0_cstr.shape[1]):
-            P0_cstr[:,i] = (self.P_cstr[:,i] - self.P_cnt[0,i]) / self.P_scl[0,i]
+        P0_cstr = (self.P_cstr - self.P_cnt) / self.P_scl
 
         P0_tot = np.concatenate([self.P0, P0_cstr], axis=0)
-        P0_tot_torch = torch.from_numpy(P0_tot).contiguous().double()
+        P0_tot_torch = self._to_torch(P0_tot)
 
         if mean is None:
             mean = gpytorch.means.ConstantMean(batch_shape=torch.Size([self.r]))
@@ -829,13 +985,13 @@ class PIGPR(GPR):
         model = (PIMultitaskGPModel(P0_torch, Vr_torch, likelihood, 
                                              mean, kernel, self.AddedLoss))
 
-        model.double()
-        likelihood.double()
+        model.to(self.device, self.dtype)
+        likelihood.to(self.device, self.dtype)
 
         model.train()
         likelihood.train()
 
-        loss_mll = likelihood(model(P0_torch)).log_prob(Vr_torch).detach().numpy()
+        loss_mll = likelihood(model(P0_torch)).log_prob(Vr_torch).detach().cpu().numpy()
 
         model.eval()
         model.likelihood.eval()
@@ -874,8 +1030,12 @@ class PIGPR(GPR):
             loss = -mll(output, Vr_torch)
             loss.backward()
             
-            e = torch.abs(loss - loss_old).item()
-            loss_old = loss
+            # The stopping criterion is moved to the host only every 10 iterations
+            delta = torch.abs(loss.detach() - loss_old)
+            loss_old = loss.detach()
+            if j % 10 == 9:
+                e = delta.item()
+
             if self.verbose == True:
                 
                 print(f'Iter {j+1:d}/{self.max_iter:d} - Loss: {loss.item():.2e} - ' \
@@ -884,7 +1044,7 @@ class PIGPR(GPR):
             optimizer.step()
             j += 1
 
-            Vr_sigma = output.stddev.detach().numpy()
+        Vr_sigma = output.stddev.detach().cpu().numpy()
 
         return model, likelihood, Vr_sigma
     
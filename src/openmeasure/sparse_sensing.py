@@ -270,6 +270,7 @@ class ROM():
         '''
         # Compute the SVD of the scaled dataset
         U, S, Vt = np.linalg.svd(X0, full_matrices=False)
+        self.Sigma = S
         A = np.matmul(np.diag(S), Vt).T
         L = S**2    # Compute the eigenvalues
         exp_variance = 100*np.cumsum(L)/np.sum(L)
@@ -492,20 +493,21 @@ class ROM():
         self.X0 = self.scale_data(scale_type, axis_cnt)
         if basis is None:
             Ur, Ar, _ = self.decomposition(self.X0, select_modes, n_modes)
+            # The norms of the columns of Ar are the singular values of X0
+            Sigma_r = self.Sigma[:Ar.shape[1]]
         else:
             Ur = basis[0]
             Ar = basis[1]
+            Sigma_r = np.linalg.norm(Ar, axis=0)
 
         self.Ur = Ur
         self.Ar = Ar
         self.r = Ar.shape[1]
 
-        # Get the singular values and the orthonormal basis
-        Vr = np.zeros_like(Ar)
-        Sigma_r = np.zeros((self.r,))
-        for i in range(self.r):
-            Sigma_r[i] = np.linalg.norm(Ar[:,i])
-            Vr[:,i] = Ar[:,i]/Sigma_r[i]
+        # Get the orthonormal basis
+        # Null modes are left unscaled to avoid dividing by zero
+        Sigma_r = np.where(Sigma_r > 0, Sigma_r, 1.)
+        Vr = Ar / Sigma_r[np.newaxis, :]
         
         self.Vr = Vr
         self.Sigma_r = Sigma_r
@@ -1,6 +1,9 @@
 import pytest
 import src.openmeasure.gpr as gpr
 import numpy as np
+import torch
+import gpytorch
+from linear_operator.utils.errors import NotPSDError
 import matplotlib.pyplot as plt
 
 class TestGPR:
@@ -43,11 +46,11 @@ class TestGPR:
     def test_centering_and_scaling_parameters(self):
         P0 = self.gpr.scale_GPR_data(self.P_train, 'std')
         
-        P_cnt = np.zeros_like(self.P_train)
-        P_scl = np.zeros_like(self.P_train)
+        P_cnt = np.zeros((self.P_train.shape[1],))
+        P_scl = np.zeros((self.P_train.shape[1],))
         for i in range(self.P_train.shape[1]):
-            P_cnt[:,i] = np.mean(self.P_train[:,i])
-            P_scl[:,i] = np.std(self.P_train[:,i])
+            P_cnt[i] = np.mean(self.P_train[:,i])
+            P_scl[i] = np.std(self.P_train[:,i])
 
         P0_check = (self.P_train - P_cnt)/P_scl 
 
@@ -55,6 +58,10 @@ class TestGPR:
         np.testing.assert_array_equal(P_scl, self.gpr.P_scl)
         np.testing.assert_array_equal(P0_check, P0)
 
+    def test_scaling_not_implemented(self):
+        with pytest.raises(NotImplementedError):
+            self.gpr.scale_GPR_data(self.P_train, 'unknown')
+
     def test_fit(self):
         self.gpr.fit(scaleX_type='none')
         np.testing.assert_allclose(np.abs(self.U), np.abs(self.gpr.Ur), atol=1e-5)
@@ -66,10 +73,134 @@ class TestGPR:
         X_pred = self.gpr.reconstruct(A_pred)
 
         np.testing.assert_allclose(self.X_test, X_pred, rtol=1e-10, atol=5e-1)
+
+    def test_train_unbatched_kernel(self):
+        self.gpr.fit(scaleX_type='none')
+        with pytest.raises(ValueError):
+            self.gpr.train(kernel=gpytorch.kernels.MaternKernel())
+
+        kernel = gpytorch.kernels.MaternKernel(batch_shape=torch.Size([self.gpr.r]))
+        self.gpr.train(kernel=kernel)
+
+    def test_train_sigma(self):
+        self.gpr.fit(scaleX_type='none')
+        self.gpr.train()
+        assert self.gpr.Vr_sigma is None
+
+        self.gpr.train(compute_sigma=True)
+        assert self.gpr.Vr_sigma.shape == (self.P_train.shape[0], self.gpr.r)
+        assert np.all(self.gpr.Vr_sigma > 0)
+
+    @pytest.mark.filterwarnings('error::gpytorch.utils.warnings.GPInputWarning')
+    def test_update(self):
+        self.gpr.fit(scaleX_type='none')
+        self.gpr.train(compute_sigma=True)
+        A_pred, A_sigma = self.gpr.predict(self.P_test)
+        n_train = self.P_train.shape[0]
+
+        # Without uncertainties the training set grows and Vr_sigma is recomputed later
+        self.gpr.update(self.P_test[:2], A_pred[:2])
+        assert self.gpr.P0_torch.shape[0] == n_train + 2
+        assert self.gpr.Vr_sigma is None
+
+        self.gpr.update(self.P_test[2:4], A_pred[2:4], A_sigma[2:4], retrain=True)
+        assert self.gpr.P0_torch.shape[0] == n_train + 4
+        assert self.gpr.Vr_torch.shape == (n_train + 4, self.gpr.r)
+        
+        # The fixed noise follows the training data also without retraining
+        self.gpr.update(self.P_test[4:6], A_pred[4:6], A_sigma[4:6])
+        assert self.gpr.Vr_sigma.shape == (n_train + 6, self.gpr.r)
+        assert self.gpr.models[0].likelihood.noise.shape == (self.gpr.r, n_train + 6)
+        
+        with pytest.raises(ValueError):
+            self.gpr.update(self.P_test[6:8], A_pred[6:8])
+        assert self.gpr.P0_torch.shape[0] == n_train + 6
+
+        A_pred_new, _ = self.gpr.predict(self.P_test)
+        X_pred = self.gpr.reconstruct(A_pred_new)
+        np.testing.assert_allclose(self.X_test, X_pred, rtol=1e-10, atol=5e-1)
+
+    def test_train_float64_fallback(self, monkeypatch):
+        train_step = gpr.GPR._train_step
+        noise_init = []
+        n_steps = []
+        
+        def failing_train_step(self, model, mll, optimizer, P0_torch, Vr_torch):
+            # Fails after a few single precision steps and records the starting noise
+            # of the double precision training
+            if P0_torch.dtype == torch.float32 and len(n_steps) == 5:
+                raise NotPSDError('Matrix not positive definite')
+            if P0_torch.dtype == torch.float64 and not noise_init:
+                noise_init.append(model.likelihood.noise.detach().clone())
+            n_steps.append(P0_torch.dtype)
+            return train_step(self, model, mll, optimizer, P0_torch, Vr_torch)
+        
+        monkeypatch.setattr(gpr.GPR, '_train_step', failing_train_step)
+        
+        self.gpr.fit(scaleX_type='none')
+        likelihood = gpytorch.likelihoods.GaussianLikelihood(batch_shape=torch.Size([self.gpr.r]))
+        noise = likelihood.noise.detach().clone()
+        self.gpr.train(likelihood=likelihood, max_iter=100)
+        
+        assert self.gpr.dtype == torch.float64
+        assert n_steps.count(torch.float64) > 0
+        assert self.gpr.P0_torch.dtype == torch.float64
+        assert all(p.dtype == torch.float64 for p in self.gpr.models[0].parameters())
+        # The retraining starts from the noise passed by the user
+        torch.testing.assert_close(noise_init[0], noise.double(), rtol=1e-6, atol=1e-8)
+        
+        A_pred, _ = self.gpr.predict(self.P_test)
+        X_pred = self.gpr.reconstruct(A_pred)
+        np.testing.assert_allclose(self.X_test, X_pred, rtol=1e-10, atol=5e-1)
+
+    def test_predict_lbfgs(self):
+        self.gpr.fit(scaleX_type='none')
+        self.gpr.train(max_iter=50, lr=1., optimizer='lbfgs')
+        A_pred, _ = self.gpr.predict(self.P_test)
+        X_pred = self.gpr.reconstruct(A_pred)
+
+        np.testing.assert_allclose(self.X_test, X_pred, rtol=1e-10, atol=5e-1)
         
         
 
         
         
 
-    
\ No newline at end of file
+    
+    def test_predict_multimode(self):
+        # Rank-3 data, so that the SingleTask models are trained as a batch of 3
+        U = np.linalg.qr(np.random.default_rng(0).normal(size=(self.n_points, 3)))[0]
+        V = np.hstack([np.sin(2*np.pi*self.P), np.cos(2*np.pi*self.P), self.P**2])
+        X = 20 + U @ (np.diag([100., 50., 20.]) @ V.T)
+        X_train = X[:, ::2]
+        X_test = X[:, 1::2]
+        
+        xyz = np.zeros((self.n_points, 3))
+        model = gpr.GPR(X_train, self.n_features, xyz, self.P_train)
+        model.fit(scaleX_type='none', select_modes='number', n_modes=3)
+        assert model.r == 3
+        
+        with pytest.raises(ValueError):
+            model.train(kernel=gpytorch.kernels.MaternKernel(batch_shape=torch.Size([1])))
+        
+        model.train(compute_sigma=True)
+        assert model.Vr_sigma.shape == (self.P_train.shape[0], 3)
+        
+        A_pred, A_sigma = model.predict(self.P_test)
+        assert A_pred.shape == (self.P_test.shape[0], 3)
+        assert A_sigma.shape == (self.P_test.shape[0], 3)
+        
+        # Each mode is compared with the projection of the test data on the basis
+        A_test = ((X_test - model.X_cnt)/model.X_scl).T @ model.Ur
+        for i in range(3):
+            err = np.max(np.abs(A_pred[:, i] - A_test[:, i]))
+            assert err < 0.1*np.max(np.abs(A_test[:, i]))
+        
+        model.update(self.P_test[:2], A_test[:2], A_sigma[:2], retrain=True)
+        assert model.Vr_torch.shape == (self.P_train.shape[0] + 2, 3)
+        
+        A_pred, _ = model.predict(self.P_test)
+        assert A_pred.shape == (self.P_test.shape[0], 3)
+        for i in range(3):
+            err = np.max(np.abs(A_pred[:, i] - A_test[:, i]))
+            assert err < 0.1*np.max(np.abs(A_test[:, i]))